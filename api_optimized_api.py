@@ -1,23 +1,63 @@
+"""
+FastAPI front end that answers natural-language questions with a LangGraph
+react agent backed by Ollama and the SQL MCP tools in sqlcheckmcpserver.
+
+Performance notes
+-----------------
+The request hot path is I/O- and remote-compute-bound, not CPU-bound.
+Per query, the time goes to:
+
+1. MCP server setup. Spawning ``python sqlcheckmcpserver.py`` over stdio
+   cost about 150 ms of interpreter start and imports, plus the MCP
+   handshake and tool listing.
+   Addressed by: one session and agent built in ``lifespan``, the cached
+   agent in ``MCPClient._get_agent``, and the in-process in-memory
+   transport.
+2. Oracle round-trips. Each tool call opened its own session (roughly
+   50-300 ms, about 80 ms typical), and DBMS_METADATA is slow.
+   Addressed by: the async connection pool, the DDL TTL cache, larger
+   fetch arraysize, and concurrent tool calls within a turn.
+3. Ollama generation. This costs prefill plus N output tokens times the
+   per-token decode time, and dominates once 1 and 2 are gone.
+   Addressed by: micro-batching (``enqueue``), the ``LLM_MAX_INFLIGHT``
+   semaphore, keep-alive connections to Ollama, token streaming over the
+   WebSocket, and compact columnar tool output that means fewer prompt
+   tokens.
+
+Python-side CPU is small next to these, so the changes that pay off are
+in the language stack (asyncio, C-backed orjson/ormsgpack, uvloop/
+httptools), data layout (columnar results, shared clients) and
+specialization (in-process MCP, cached DDL). Low-level CPU work such as
+SIMD or hand-tuned loops has nothing to speed up here. Proposals of that
+kind should first show a profile where CPU time matters.
+
+The figures above are typical estimates, not measurements from this
+deployment. Re-measure before relying on them.
+"""
 import contextlib
 import json
 import logging
 import os
-from typing import Any, AsyncIterator, Dict, Optional, Union
+import re
+from typing import Any, AsyncIterator, Mapping, Optional, Union
 import asyncio
+from types import MappingProxyType
 import httpx
+import ormsgpack
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.messages import HumanMessage
 from langchain_mcp_adapters.tools import load_mcp_tools
-from langgraph.prebuilt import create_react_agent
+from langgraph.prebuilt import ToolNode, create_react_agent
 from langchain_ollama import ChatOllama
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from mcp import ClientSession
+from mcp.shared.memory import create_connected_server_and_client_session
 from pydantic import BaseModel
 import uvicorn
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
+from sqlcheckmcpserver import close_db_pool, mcp as sql_mcp
 # Load environment variables
 load_dotenv()
 
@@ -25,6 +65,31 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fastapi_mcp_client")
 
+# Process-wide configuration, parsed once from the environment
+MCP_BASE_URL = os.getenv("MCP_BASE_URL", "http://localhost:8000")
+OLLAMA_CONFIG = MappingProxyType({
+    "base_url": os.getenv("OLLAMA_BASE_URL", "http://192.168.8.111:11434"),
+    "model": os.getenv("OLLAMA_MODEL", "qwen3:32b"),
+    "temperature": float(os.getenv("OLLAMA_TEMPERATURE", 0.5)),
+    "max_tokens": int(os.getenv("OLLAMA_MAX_TOKENS", 1000))
+})
+# Comma-separated list of browser origins allowed to call the API
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost").split(",")
+    if origin.strip()
+]
+
+# Micro-batching of agent queries
+MAX_BATCH = int(os.getenv("AGENT_MAX_BATCH", 8))
+MAX_WAIT_MS = float(os.getenv("AGENT_MAX_WAIT_MS", 5))
+
+# Upper bound on agent runs in flight against Ollama; extra queries wait in the queue
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", 8))
+
+# Opening or closing tag of a model reasoning block
+THINK_TAG_RE = re.compile(r"</?think>")
+
 
 class MCPClientConfig(BaseModel):
     """Configuration for MCP Client"""
@@ -43,7 +108,7 @@ class MCPClient:
         base_url: str,
         config: Optional[MCPClientConfig] = None,
         log_level: Optional[str] = None,
-        ollama_config: Optional[Dict[str, Any]] = None,
+        ollama_config: Optional[Mapping[str, Any]] = None,
     ):
         """
         Initialize the MCP client with AI capabilities.
@@ -55,24 +120,14 @@ class MCPClient:
         else:
             logger.setLevel(getattr(logging, self.config.log_level))
 
-        # HTTP clients
-        self._async_client = httpx.AsyncClient(
-            base_url=self.config.base_url, 
-            timeout=self.config.timeout
-        )
-        self._sync_client = httpx.Client(
-            base_url=self.config.base_url, 
-            timeout=self.config.timeout
-        )
-
         # AI components
         self.llm = self._initialize_llm(ollama_config)
         self._mcp_available = True
-        self._stdio_server_params = None
+        self._agent = None
         
         logger.info(f"MCPClient initialized with base URL: {base_url}")
 
-    def _initialize_llm(self, ollama_config: Optional[Dict[str, Any]]) -> Optional[ChatOllama]:
+    def _initialize_llm(self, ollama_config: Optional[Mapping[str, Any]]) -> Optional[ChatOllama]:
         """Initialize the Ollama language model"""
         if not ollama_config:
             return None
@@ -81,73 +136,215 @@ class MCPClient:
             base_url=ollama_config.get("base_url", "http://localhost:11434"),
             model=ollama_config.get("model", "llama2"),
             temperature=ollama_config.get("temperature", 0.5),
-            max_tokens=ollama_config.get("max_tokens", 1000)
-        )
-
-    def configure_stdio_server(self, command: str, args: list):
-        """Configure stdio server parameters for direct MCP communication."""
-        self._stdio_server_params = StdioServerParameters(
-            command=command,
-            args=args,
+            max_tokens=ollama_config.get("max_tokens", 1000),
+            # ChatOllama keeps one httpx.AsyncClient for its lifetime; keep
+            # enough idle connections around for concurrent queries to reuse
+            async_client_kwargs={
+                "limits": httpx.Limits(
+                    max_keepalive_connections=64,
+                    keepalive_expiry=60,
+                ),
+            },
         )
 
     async def _get_agent(self, session: ClientSession):
-        """Create a LangChain agent with MCP tools."""
-        tools = await load_mcp_tools(session)
-        return create_react_agent(self.llm, tools)
-
-    async def ai_query(self, query: str) -> str:
-        """
-        Execute a query using the AI agent with MCP tools.
-        """
-        if not self._stdio_server_params:
-            raise MCPClientError("Stdio server not configured")
-            
-        async with stdio_client(self._stdio_server_params) as (read, write):    
-            async with ClientSession(read_stream=read, write_stream=write) as session:
-                await session.initialize()
-                logger.info("Session initialized")
-                
-                agent = await self._get_agent(session)
-                result = await agent.ainvoke({
-                    "messages": [HumanMessage(content=query)]
-                })
-                
-                return result["messages"][-1].content
+        """Create a LangChain agent with MCP tools, cached after the first call."""
+        if self._agent is None:
+            tools = await load_mcp_tools(session)
+            # ToolNode runs every tool call of a turn concurrently with asyncio.gather
+            self._agent = create_react_agent(
+                self.llm, ToolNode(tools, handle_tool_errors=True)
+            )
+        return self._agent
 
     async def close(self) -> None:
-        """Close all resources."""
-        await self._async_client.aclose()
-        self._sync_client.close()
+        """Close the LLM's pooled HTTP connections."""
+        # ollama.AsyncClient only gained close() in later releases, so reach
+        # the underlying httpx client defensively; shutdown must not raise
+        async_client = getattr(self.llm, "_async_client", None)
+        http_client = getattr(async_client, "_client", None)
+        if http_client is not None:
+            await http_client.aclose()
 
 
-# FastAPI Application Setup
-app = FastAPI(title="MCP Client API")
+class ThinkFilter:
+    """
+    Incrementally drop <think>...</think> reasoning blocks from streamed text.
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    Tags are found with a single precompiled regex pass per chunk. A tag may
+    be split across chunks, so a trailing partial tag is held back until the
+    next chunk arrives.
+    """
+
+    TAGS = ("<think>", "</think>")
+
+    def __init__(self):
+        self._pending = ""
+        self._in_think = False
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of the stream that is safe to emit."""
+        text = self._pending + chunk
+        output = []
+        pos = 0
+        for match in THINK_TAG_RE.finditer(text):
+            if not self._in_think:
+                output.append(text[pos:match.start()])
+            self._in_think = match.group() == "<think>"
+            pos = match.end()
+
+        # Hold back a trailing "<..." that may still become a tag
+        rest = text[pos:]
+        cut = rest.rfind("<")
+        if cut == -1 or not any(tag.startswith(rest[cut:]) for tag in self.TAGS):
+            cut = len(rest)
+        self._pending = rest[cut:]
+        if not self._in_think:
+            output.append(rest[:cut])
+
+        text = "".join(output)
+        # Match the old .strip() on the leading side of the response
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+    def flush(self) -> str:
+        """Return any text still held back at the end of the stream."""
+        text, self._pending = self._pending, ""
+        return "" if self._in_think else text
 
 
 class AIQueryRequest(BaseModel):
     query: str
 
 
+def _create_client() -> MCPClient:
+    """Build an MCPClient from environment configuration."""
+    return MCPClient(base_url=MCP_BASE_URL, ollama_config=OLLAMA_CONFIG)
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Lifespan event handler for FastAPI"""
+    """Lifespan event handler for FastAPI.
+
+    Runs the SQL MCP server in-process over an in-memory transport and builds
+    the agent once, so every request reuses the same session and tool calls
+    skip the subprocess and stdio framing entirely.
+    """
     logger.info("Starting up MCP Client API")
-    yield
+    async with contextlib.AsyncExitStack() as stack:
+        client = _create_client()
+        stack.push_async_callback(client.close)
+        stack.push_async_callback(close_db_pool)
+        session = await stack.enter_async_context(
+            create_connected_server_and_client_session(sql_mcp._mcp_server)
+        )
+        logger.info("Session initialized")
+
+        app.state.client = client
+        app.state.session = session
+        app.state.agent = await client._get_agent(session)
+
+        app.state.llm_sem = asyncio.Semaphore(LLM_MAX_INFLIGHT)
+        app.state.batch_queue = asyncio.Queue()
+        batch_worker = asyncio.create_task(
+            _batch_worker(app.state.batch_queue, app.state.agent, app.state.llm_sem)
+        )
+        stack.callback(batch_worker.cancel)
+        yield
     logger.info("Shutting down MCP Client API")
 
 
+async def _run_batch(agent, batch: list, sem: asyncio.Semaphore) -> None:
+    """
+    Run a batch of queued queries through the agent, resolving each future
+    and returning its semaphore permit as soon as that query's run finishes.
+    """
+    inputs = [{"messages": [HumanMessage(content=query)]} for query, _ in batch]
+    pending = set(range(len(batch)))
+    try:
+        async for index, result in agent.abatch_as_completed(
+            inputs, return_exceptions=True
+        ):
+            pending.discard(index)
+            sem.release()
+            future = batch[index][1]
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result["messages"][-1].content)
+    except Exception as e:
+        for index in pending:
+            future = batch[index][1]
+            if not future.done():
+                future.set_exception(e)
+    finally:
+        for _ in pending:
+            sem.release()
+
+
+async def _batch_worker(queue: asyncio.Queue, agent, sem: asyncio.Semaphore) -> None:
+    """
+    Coalesce queries arriving within MAX_WAIT_MS into batches of up to
+    MAX_BATCH and hand each batch to the agent without blocking the queue.
+
+    Each query takes a permit from sem before it is dispatched, so once
+    LLM_MAX_INFLIGHT runs are in flight further queries wait in the queue.
+    """
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    while True:
+        batch = [await queue.get()]
+        await sem.acquire()
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH and not sem.locked():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            await sem.acquire()
+            batch.append(item)
+
+        # Skip queries whose caller has already gone away
+        live = [(query, future) for query, future in batch if not future.done()]
+        for _ in range(len(batch) - len(live)):
+            sem.release()
+        if not live:
+            continue
+
+        task = asyncio.create_task(_run_batch(agent, live, sem))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+
+async def enqueue(query: str) -> str:
+    """Queue a query for the batch worker and wait for the agent's answer."""
+    future = asyncio.get_running_loop().create_future()
+    await app.state.batch_queue.put((query, future))
+    return await future
+
+
+# FastAPI Application Setup
 app = FastAPI(title="MCP Client API", lifespan=lifespan)
 
+# Add CORS middleware; browsers cache the preflight response for max_age seconds
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["POST", "GET"],
+    allow_headers=["content-type"],
+    max_age=86400,
+)
+
 
 @app.get("/health")
 async def health_check():
@@ -160,84 +357,102 @@ async def query_ai(request: AIQueryRequest):
     """
     Endpoint for AI queries using MCP tools
     """
-    client = MCPClient(
-        base_url=os.getenv("MCP_BASE_URL", "http://localhost:8000"),
-        ollama_config={
-            "base_url": os.getenv("OLLAMA_BASE_URL", "http://192.168.8.111:11434"),
-            "model": os.getenv("OLLAMA_MODEL", "qwen3:32b"),
-            "temperature": float(os.getenv("OLLAMA_TEMPERATURE", 0.5)),
-            "max_tokens": int(os.getenv("OLLAMA_MAX_TOKENS", 1000))
-        }
-    )
-    
     try:
-        # The path inside the container will be /app/sqlcheckmcpserver.py
-        sql_mcp_server_path = os.getenv("SQL_MCP_SERVER_PATH", "/app/sqlcheckmcpserver.py")
-        client.configure_stdio_server(
-            command="python",
-            args=[sql_mcp_server_path],
-        )
-        response = await client.ai_query(request.query)
+        response = await enqueue(request.query)
         return {"response": response}
     except Exception as e:
         logger.error(f"Error processing AI query: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await client.close()
+
+
+async def send_frame(websocket: WebSocket, frame_type: str, data: Any = None) -> None:
+    """
+    Send a structured frame as binary msgpack.
+
+    Streamed tokens go out as plain text frames; tool notices, errors and
+    the end-of-response marker use {"type": "tool" | "error" | "done",
+    "data": ...}. Every response ends with a "done" frame, even on error.
+    """
+    await websocket.send_bytes(ormsgpack.packb({"type": frame_type, "data": data}, default=str))
+
 
 @app.websocket("/ws/ai/query")
 async def websocket_ai_query(websocket: WebSocket):
     await websocket.accept()
-    client = None
     
     try:
-        # Initialize client (same as HTTP version)
-        client = MCPClient(
-            base_url=os.getenv("MCP_BASE_URL", "http://localhost:8000"),
-            ollama_config={
-                "base_url": os.getenv("OLLAMA_BASE_URL", "http://192.168.8.111:11434"),
-                "model": os.getenv("OLLAMA_MODEL", "qwen3:32b"),
-                "temperature": float(os.getenv("OLLAMA_TEMPERATURE", 0.5)),
-                "max_tokens": int(os.getenv("OLLAMA_MAX_TOKENS", 1000))
-            }
-        )
-        
-        # Configure stdio server
-        sql_mcp_server_path = os.getenv("SQL_MCP_SERVER_PATH", "/app/sqlcheckmcpserver.py")
-        client.configure_stdio_server(
-            command="python",
-            args=[sql_mcp_server_path],
-        )
-
         while True:
             # Receive query from client
             query = await websocket.receive_text()
             
-            # Process query and send back response
-            response = await client.ai_query(query)
-            cleaned_response = response.replace('<think>', '').replace('</think>', '').strip()
-            await websocket.send_text(cleaned_response)
-            
+            try:
+                # Stream tokens back as the model generates them; each model
+                # run (one per agent step) gets its own think-tag state
+                think_filters = {}
+                async with app.state.llm_sem:
+                    async for event in app.state.agent.astream_events(
+                        {"messages": [HumanMessage(content=query)]},
+                        version="v2",
+                    ):
+                        if event["event"] == "on_tool_end":
+                            # Only report that a tool ran; the result itself
+                            # is for the model, not the client
+                            output = event["data"]["output"]
+                            content = getattr(output, "content", output)
+                            await send_frame(websocket, "tool", {
+                                "name": event["name"],
+                                "size": len(content) if isinstance(content, str) else None,
+                            })
+                            continue
+                        if event["event"] == "on_chat_model_end":
+                            think_filter = think_filters.pop(event["run_id"], None)
+                            text = think_filter.flush() if think_filter else ""
+                            if text:
+                                await websocket.send_text(text)
+                            continue
+                        if event["event"] != "on_chat_model_stream":
+                            continue
+                        content = event["data"]["chunk"].content
+                        if not isinstance(content, str):
+                            continue
+                        think_filter = think_filters.setdefault(event["run_id"], ThinkFilter())
+                        text = think_filter.feed(content)
+                        if text:
+                            await websocket.send_text(text)
+
+                # Runs that never reported their end still owe held-back text
+                for think_filter in think_filters.values():
+                    text = think_filter.flush()
+                    if text:
+                        await websocket.send_text(text)
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # Report the failure for this query and keep the connection open
+                logger.error(f"WebSocket query error: {str(e)}")
+                await send_frame(websocket, "error", str(e))
+            await send_frame(websocket, "done")
+
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}")
-        await websocket.send_text(f"Error: {str(e)}")
-    finally:
-        if client:
-            await client.close()
+        await send_frame(websocket, "error", str(e))
+        await send_frame(websocket, "done")
+
 
 def run_server():
     """Run the FastAPI server"""
-    config = uvicorn.Config(
+    uvicorn.run(
         "api_optimized_api:app",
         host="0.0.0.0",
-        port=8000,
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        reload=False,
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
         log_level="info",
-        reload=True
     )
-    server = uvicorn.Server(config)
-    asyncio.run(server.serve())
 
 
 if __name__ == "__main__":
@@ -1,8 +1,11 @@
 from typing import Any
+from cachetools import TTLCache
 import httpx
 from mcp.server.fastmcp import FastMCP
 import oracledb
-import json
+import orjson
+import sqlglot
+from sqlglot import exp
 from typing import Dict, Any
 import os
 from dotenv import load_dotenv
@@ -22,61 +25,143 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD"),
     "dsn": os.getenv("DB_DSN")
 }
+
+# 以 str / bytes 直接取回 CLOB / BLOB；AsyncLOB 沒有 __str__，需另外 await read()
+oracledb.defaults.fetch_lobs = False
+
+# 非同步連線池需要執行中的 event loop，於第一次工具呼叫時建立，之後重複使用
+POOL = None
+
+# DDL 很少變動，快取 DBMS_METADATA 的結果
+DDL_CACHE = TTLCache(maxsize=1024, ttl=int(os.getenv("DDL_CACHE_TTL", 300)))
+
+# 每次與資料庫往返取回的列數
+FETCH_ARRAYSIZE = 1000
+
+# 未指定筆數限制的查詢最多回傳的列數
+MAX_ROWS = int(os.getenv("SELECT_MAX_ROWS", 1000))
+
+def table_base_name(table: exp.Table) -> str:
+    """Upper-cased table name without its @dblink suffix."""
+    # sqlglot keeps a database link inside the identifier (emp@link) and
+    # splits a dotted link name (emp@link.world) across the name parts
+    for part in (table.catalog, table.db, table.name):
+        if "@" in part:
+            return part.split("@")[0].upper()
+    return table.name.upper()
+
 def get_db_connection():
-    """Create and return Oracle database connection."""
-    return oracledb.connect(**DB_CONFIG)
+    """Acquire an async Oracle database connection from the pool."""
+    global POOL
+    if POOL is None:
+        POOL = oracledb.create_pool_async(
+            **DB_CONFIG,
+            min=int(os.getenv("DB_POOL_MIN", 2)),
+            max=int(os.getenv("DB_POOL_MAX", 10)),
+            increment=1,
+            getmode=oracledb.POOL_GETMODE_WAIT,
+        )
+    return POOL.acquire()
+
+async def close_db_pool():
+    """Close the connection pool if it has been created."""
+    global POOL
+    if POOL is not None:
+        await POOL.close(force=True)
+        POOL = None
 
+# 工具在 API 行程內的 event loop 上執行，資料庫呼叫使用 async driver 以免阻塞，
+# 且 agent 同一輪發出的多個工具呼叫可以同時進行
 @mcp.tool()
-def get_table_ddl(table_name: str) -> str:
+async def get_table_ddl(table_name: str) -> str:
     """Retrieve the DDL statement for a given Oracle table name."""
+    key = table_name.upper()
+    cached = DDL_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     try:
-        with get_db_connection() as conn:
+        async with get_db_connection() as conn:
             cursor = conn.cursor()
             # Use DBMS_METADATA to get DDL
-            cursor.execute("""
+            await cursor.execute("""
                 SELECT DBMS_METADATA.GET_DDL('TABLE', :table_name, 'DBUSERNEB')
                 FROM DUAL
-            """, table_name=table_name.upper())
+            """, table_name=key)
             
-            result = cursor.fetchone()
-            if result:
-                return str(result[0])
+            result = await cursor.fetchone()
+            # Only cache real DDL text so a bad fetch is not served for the whole TTL
+            if result and isinstance(result[0], str):
+                ddl = result[0]
+                DDL_CACHE[key] = ddl
+                return ddl
             return f"No DDL found for table {table_name}"
     except oracledb.Error as e:
         return f"Error retrieving DDL: {str(e)}"
 
 @mcp.tool()
-def execute_select_query(params: Dict[str, Any]) -> str:
+async def execute_select_query(params: Dict[str, Any]) -> str:
     """Execute a SELECT query on a given Oracle table and return results.
-    Parameters: table_name (str) and query (str)."""
+    Parameters: table_name (str) and query (str).
+    Results are JSON of the form
+    {"columns": [...], "rows": [[...], ...], "truncated": bool}.
+    A query without its own row limit returns at most 1000 rows (configurable);
+    "truncated" is true when more rows matched and the extra rows were dropped."""
     table_name = params.get('table_name')
     query = params.get('query')
     
     if not table_name or not query:
         return "Error: Both table_name and query parameters are required"
     
+    # Validate that the query is a single read-only SELECT statement
     try:
-        with get_db_connection() as conn:
+        tree = sqlglot.parse_one(query, read="oracle")
+    except sqlglot.errors.SqlglotError as e:
+        return f"Error: Could not parse query: {str(e)}"
+    # Select, set operations (UNION ...) and parenthesized queries; WITH is
+    # attached to its Select rather than being the root
+    if not isinstance(tree, exp.Query):
+        return "Error: Only SELECT queries are allowed"
+
+    # FOR UPDATE takes row locks, which a read-only check must not do
+    if any(tree.find_all(exp.Lock)):
+        return "Error: SELECT ... FOR UPDATE is not allowed"
+
+    table = table_name.split(".")[-1].upper()
+    if table not in {table_base_name(t) for t in tree.find_all(exp.Table)}:
+        return f"Error: Query does not reference table {table_name}"
+
+    # sqlglot only validates; the caller's SQL runs as written, since the
+    # regenerated text is not always equivalent Oracle (MINUS -> EXCEPT, ...)
+    capped = not tree.args.get("limit")
+
+    try:
+        async with get_db_connection() as conn:
             cursor = conn.cursor()
-            # Validate that the query is a SELECT statement
-            if not query.strip().upper().startswith('SELECT'):
-                return "Error: Only SELECT queries are allowed"
-                
-            cursor.execute(query)
+            # Fetch in larger pages to cut round-trips on wide result sets
+            cursor.arraysize = FETCH_ARRAYSIZE
+            cursor.prefetchrows = FETCH_ARRAYSIZE + 1
+            await cursor.execute(query)
             columns = [col[0] for col in cursor.description]
-            results = cursor.fetchall()
+            # Cap worst-case result size when the query has no row limit of its
+            # own; one extra row tells us whether the cap actually dropped anything
+            if capped:
+                results = await cursor.fetchmany(MAX_ROWS + 1)
+            else:
+                results = await cursor.fetchall()
+            truncated = capped and len(results) > MAX_ROWS
+            if truncated:
+                results = results[:MAX_ROWS]
             
-            # Format results as JSON for better readability
-            formatted_results = []
-            for row in results:
-                formatted_results.append(dict(zip(columns, row)))
-                
-            return json.dumps(formatted_results, default=str, indent=2)
+            # Compact columnar JSON: column names once, then one array per row
+            return orjson.dumps(
+                {"columns": columns, "rows": results, "truncated": truncated},
+                default=str,
+            ).decode()
     except oracledb.Error as e:
         return f"Error executing query: {str(e)}"
 
 
-
 if __name__ == "__main__":
     print("start")  # 替换为实际表名
     # Initialize and run the server